@@ -1,94 +1,669 @@
 import os
 import shutil
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import asyncio
+import numpy as np
+import httpx
+import chromadb
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import streamlit as st
 
 # --- LangChain Imports ---
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from langchain.chains import RetrievalQA
 from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
 
 # --- OLLAMA IMPORTS (For both LLM and Embeddings) ---
-from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_ollama import ChatOllama
 
 # ---------------------------------------------------------
 # CONFIGURATION
 # ---------------------------------------------------------
 PERSIST_DIRECTORY = "./chroma_db_qwen"
+# Chroma server started with: chroma run --path ./chroma_db_qwen --port 8000
+CHROMA_HOST = "localhost"
+CHROMA_PORT = 8000
+# langchain-chroma's default collection name. The embedded store has always used it,
+# and the server shares the same directory, so both backends see the same data
+CHROMA_COLLECTION = "langchain"
+# How often a process stuck on the embedded fallback checks whether the server came up
+CHROMA_PROBE_SECONDS = 30
+# Minimum gap between attempts to rebuild a RAGSystem whose initialization failed
+INIT_RETRY_SECONDS = 30
+OLLAMA_BASE_URL = "http://localhost:11434"
+EMBED_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = 64
+# Batches in flight at once; Ollama queues them, so more only adds memory pressure
+EMBED_CONCURRENCY = 4
+# How long Ollama keeps models loaded after the last request
+OLLAMA_KEEP_ALIVE = "24h"
+EMBED_CACHE_PATH = "embed_cache.db"
+QUERY_EMBED_CACHE_SIZE = 512
+QUERY_CACHE_THRESHOLD = 0.95
+QUERY_CACHE_SIZE = 256
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+WRITE_BATCH_SIZE = 256
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "app.css")
+# Retrieval: MMR picks TOP_K diverse chunks out of the MMR_FETCH_K nearest, then each
+# chunk is trimmed to its CONTEXT_SENTENCES sentences closest to the query
+TOP_K = 3
+MMR_FETCH_K = 10
+MMR_LAMBDA = 0.5
+CONTEXT_SENTENCES = 3
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s")
+# Below this many chunks a brute-force BLAS scan beats Chroma's HNSW + retriever overhead
+FAST_PATH_MAX_CHUNKS = 50_000
+# Rows dequantized per step when scoring the int8 matrix; keeps the float32 temp cache-sized
+SCORE_BLOCK_ROWS = 4096
+# Raw fast-path store, memory-mapped at startup instead of rebuilt from Chroma
+FAST_PATH_DIRECTORY = "./fast_index"
+FAST_PATH_EMBEDS = os.path.join(FAST_PATH_DIRECTORY, "embeds.i8")
+FAST_PATH_SCALES = os.path.join(FAST_PATH_DIRECTORY, "scales.f32")
+FAST_PATH_DOCS = os.path.join(FAST_PATH_DIRECTORY, "docs.jsonl")
+
+# Stuff-style QA prompt, same wording as LangChain's RetrievalQA default
+QA_PROMPT_TEMPLATE = (
+    "Use the following pieces of context to answer the question at the end. "
+    "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n\n"
+    "{context}\n\n"
+    "Question: {question}\n"
+    "Helpful Answer:"
+)
+
+# ---------------------------------------------------------
+# BATCHED EMBEDDINGS
+# ---------------------------------------------------------
+class OllamaBatchEmbeddings(Embeddings):
+    """Embeds texts through Ollama's /api/embed, EMBED_BATCH_SIZE inputs per request.
+
+    The stock OllamaEmbeddings issues one HTTP round-trip per chunk; here whole batches
+    are posted, so N chunks cost ceil(N / batch_size) calls, and up to EMBED_CONCURRENCY
+    of those calls overlap so Ollama can start on the next batch as soon as one finishes.
+    """
+
+    def __init__(self, model=EMBED_MODEL, base_url=OLLAMA_BASE_URL, batch_size=EMBED_BATCH_SIZE,
+                 keep_alive=OLLAMA_KEEP_ALIVE, concurrency=EMBED_CONCURRENCY):
+        self.model = model
+        self.url = f"{base_url}/api/embed"
+        self.batch_size = batch_size
+        self.keep_alive = keep_alive
+        self.concurrency = concurrency
+        # Keep-alive client for single query embeddings
+        self.client = httpx.Client(timeout=60)
+
+    def _payload(self, batch):
+        return {"model": self.model, "input": batch, "keep_alive": self.keep_alive}
+
+    async def _embed_all(self, texts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with httpx.AsyncClient(timeout=60) as client:
+            async def one(batch):
+                async with semaphore:
+                    resp = await client.post(self.url, json=self._payload(batch))
+                resp.raise_for_status()
+                return resp.json()["embeddings"]
+
+            results = await asyncio.gather(*(
+                one(texts[i:i + self.batch_size]) for i in range(0, len(texts), self.batch_size)
+            ))
+        return [vec for batch in results for vec in batch]
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return asyncio.run(self._embed_all(list(texts)))
+
+    def embed_query(self, text):
+        resp = self.client.post(self.url, json=self._payload([text]))
+        resp.raise_for_status()
+        return resp.json()["embeddings"][0]
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """Memoizes embed_query so Streamlit reruns of the same query skip Ollama.
+
+    embed_documents passes straight through; ingestion has its own on-disk cache.
+    """
+
+    def __init__(self, base, maxsize=QUERY_EMBED_CACHE_SIZE):
+        self.base = base
+        self.model = base.model
+        # Tuples keep the cached vectors immutable; callers get a fresh list copy
+        self._embed_query = lru_cache(maxsize=maxsize)(lambda q: tuple(base.embed_query(q)))
+
+    def embed_documents(self, texts):
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text):
+        return list(self._embed_query(text))
+
+# ---------------------------------------------------------
+# TEXT SPLITTING
+# ---------------------------------------------------------
+class PrefixSumTextSplitter:
+    """Recursive character splitter that measures chunk lengths via prefix sums.
+
+    The text is broken once into pieces (paragraphs, then lines, words, characters
+    for anything still too long) that concatenate back to the original. A cumulative
+    length array over those pieces makes every window length an O(1) subtraction,
+    and each chunk is a plain slice of the source text.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                 separators=("\n\n", "\n", " ", "")):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators
+
+    def _pieces(self, text, separators):
+        sep = next((s for s in separators if s == "" or s in text), "")
+        if sep == "":
+            return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+        parts = text.split(sep)
+        # Keep the separator on each piece so the pieces still add up to the text
+        parts = [p + sep for p in parts[:-1]] + [parts[-1]]
+        rest = separators[separators.index(sep) + 1:]
+        pieces = []
+        for part in parts:
+            if len(part) > self.chunk_size:
+                pieces.extend(self._pieces(part, rest))
+            elif part:
+                pieces.append(part)
+        return pieces
+
+    def split_text(self, text):
+        pieces = self._pieces(text, self.separators)
+        offsets = np.concatenate(([0], np.cumsum([len(p) for p in pieces])))
+        n = len(pieces)
+
+        chunks = []
+        start = 0
+        while start < n:
+            # Furthest piece boundary that keeps the window within chunk_size
+            end = int(np.searchsorted(offsets, offsets[start] + self.chunk_size, side="right")) - 1
+            end = max(end, start + 1)
+            chunk = text[offsets[start]:offsets[end]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+            # Earliest boundary whose tail fits in the overlap, but late enough that the
+            # next window still takes in the following piece; otherwise it would end at
+            # `end` again and emit a chunk contained in this one
+            overlap_start = int(np.searchsorted(offsets, offsets[end] - self.chunk_overlap))
+            fit_start = int(np.searchsorted(offsets, offsets[end + 1] - self.chunk_size))
+            start = max(overlap_start, fit_start, start + 1)
+        return chunks
+
+    def split_documents(self, documents):
+        return [
+            Document(page_content=chunk, metadata=dict(doc.metadata))
+            for doc in documents
+            for chunk in self.split_text(doc.page_content)
+        ]
 
 # ---------------------------------------------------------
 # CORE RAG SYSTEM CLASS
 # ---------------------------------------------------------
 class RAGSystem:
     def __init__(self):
+        # Semantic answer cache: L2-normalized query vectors and their (answer, sources)
+        self._qcache_vecs = np.empty((0, 0), dtype=np.float32)
+        self._qcache_entries = []
+        # Sessions share this instance: the lock keeps rows and entries aligned, and the
+        # generation lets answers computed before a clear be dropped instead of stored
+        self._qcache_lock = threading.Lock()
+        self._qcache_generation = 0
+        # Chroma writes run here so embedding of batch N+1 overlaps the write of batch N
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        # One RAGSystem is shared by every session, so ingestion and learning are serialized
+        self._write_lock = threading.Lock()
+        # content_hash of every chunk already in the collection
+        self.seen = set()
+        # In-memory fast path: L2-normalized chunk vectors stored as int8 rows (N, d)
+        # with a per-row float32 scale (N,), plus the matching Documents
+        self.mat = np.empty((0, 0), dtype=np.int8)
+        self.scale = np.empty(0, dtype=np.float32)
+        self.docs = []
+        self._fast_path = True
+        self.chroma_server = False
+        self.created_at = time.monotonic()
+
         try:
             # 1. Initialize Embeddings
-            self.embedding_model = OllamaEmbeddings(model="nomic-embed-text")
+            self.embedding_model = QueryCachedEmbeddings(OllamaBatchEmbeddings())
+
+            # 1b. Persistent embedding cache: sha256(model + text) -> float32 bytes
+            self.cache = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+            self.cache.execute("CREATE TABLE IF NOT EXISTS emb(key BLOB PRIMARY KEY, vec BLOB)")
+            # Queries (sentence trimming) and ingestion share the connection across threads
+            self._cache_lock = threading.Lock()
             
-            # 2. Initialize Vector Database
-            if os.path.exists(PERSIST_DIRECTORY):
-                self.vectordb = Chroma(persist_directory=PERSIST_DIRECTORY, 
-                                       embedding_function=self.embedding_model)
-            else:
-                self.vectordb = None 
+            # 2. Initialize Vector Database (Chroma server first, embedded store as fallback)
+            try:
+                self.vectordb = self._open_chroma_server()
+                self.chroma_server = True
+            except Exception:
+                st.warning(f"No Chroma server at {CHROMA_HOST}:{CHROMA_PORT}; using the embedded store. "
+                           f"Start one with `chroma run --path {PERSIST_DIRECTORY} --port {CHROMA_PORT}` for faster inserts.")
+                if os.path.exists(PERSIST_DIRECTORY):
+                    self.vectordb = Chroma(persist_directory=PERSIST_DIRECTORY, 
+                                           collection_name=CHROMA_COLLECTION,
+                                           embedding_function=self.embedding_model)
+                else:
+                    self.vectordb = None 
+
+            if self.vectordb is not None:
+                self._load_seen()
+            self._load_fast_path()
 
             # 3. Initialize LLM
             self.llm = ChatOllama(
                 model="qwen2.5-coder:3b", 
                 temperature=0.3,
-                keep_alive="5m"
+                keep_alive=OLLAMA_KEEP_ALIVE
             )
+
+            # 4. Load both models in the background so the first query hits warm weights
+            threading.Thread(target=self._warm_up, daemon=True).start()
         except Exception as e:
             st.error(f"Failed to connect to Ollama. Ensure Ollama is running and models are pulled. Error: {e}")
             self.vectordb = None
             self.llm = None
 
-    def ingest_documents(self, file_path):
+    def _open_chroma_server(self):
+        client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        client.heartbeat()
+        return Chroma(client=client,
+                      collection_name=CHROMA_COLLECTION,
+                      embedding_function=self.embedding_model)
+
+    def connect_chroma_server(self):
+        """Moves a running instance from the embedded fallback onto the Chroma server."""
+        with self._write_lock:
+            if self.chroma_server:
+                return
+            try:
+                vectordb = self._open_chroma_server()
+            except Exception:
+                return  # still unreachable; stay on the embedded store
+            self.vectordb = vectordb
+            self.chroma_server = True
+            # Same directory and collection, so this normally keeps the existing index
+            self._load_seen()
+            self._load_fast_path()
+            self._clear_query_cache()
+
+    def close(self):
+        # Waits for any in-flight ingest before releasing pools and connections
+        with self._write_lock:
+            self._io_pool.shutdown(wait=True)
+            if getattr(self, "cache", None) is not None:
+                self.cache.close()
+            if getattr(self, "embedding_model", None) is not None:
+                self.embedding_model.base.client.close()
+
+    def _warm_up(self):
+        try:
+            # An empty prompt makes Ollama load the weights without generating anything,
+            # so the first real query never queues behind a warm-up reply
+            httpx.post(f"{OLLAMA_BASE_URL}/api/generate",
+                       json={"model": self.llm.model, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE},
+                       timeout=120).raise_for_status()
+            self.embedding_model.base.embed_query("warmup")
+        except Exception:
+            pass  # best effort; a real request will surface any Ollama problem
+
+    def ingest_documents(self, text, source):
         try:
-            loader = TextLoader(file_path, encoding='utf-8')
-            documents = loader.load()
+            documents = [Document(page_content=text, metadata={"source": source})]
             
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
+            text_splitter = PrefixSumTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
             chunks = text_splitter.split_documents(documents)
             
-            if self.vectordb is None:
-                self.vectordb = Chroma.from_documents(
-                    documents=chunks, 
-                    embedding=self.embedding_model, 
-                    persist_directory=PERSIST_DIRECTORY
-                )
-            else:
-                self.vectordb.add_documents(chunks)
+            with self._write_lock:
+                if self.vectordb is None:
+                    self.vectordb = Chroma(persist_directory=PERSIST_DIRECTORY,
+                                           collection_name=CHROMA_COLLECTION,
+                                           embedding_function=self.embedding_model)
+
+                new_chunks = self._new_chunks(chunks)
+                pending = []
+                errors = []
+                try:
+                    for i in range(0, len(new_chunks), WRITE_BATCH_SIZE):
+                        batch = new_chunks[i:i + WRITE_BATCH_SIZE]
+                        pending.append((batch, *self._add_chunks(batch)))
+                except Exception as e:
+                    errors.append(e)
+                # Settle every submitted write, even after a failure, so the fast path and
+                # `seen` end up matching exactly what Chroma stored
+                for batch, future, vectors in pending:
+                    try:
+                        self._finish_batch(batch, future, vectors)
+                    except Exception as e:
+                        errors.append(e)
+                self._clear_query_cache()
+                if errors:
+                    raise errors[0]
                 
-            return f"Successfully processed {len(chunks)} chunks using Ollama embeddings."
+            return (f"Successfully processed {len(chunks)} chunks using Ollama embeddings "
+                    f"({len(new_chunks)} new, {len(chunks) - len(new_chunks)} already known).")
         except Exception as e:
             return f"Error during ingestion: {e}"
 
+    def get_or_compute(self, texts):
+        """Returns one embedding per text, only sending cache misses to Ollama."""
+        model = self.embedding_model.model
+        keys = [hashlib.sha256(f"{model}\0{t}".encode("utf-8")).digest() for t in texts]
+
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below SQLite's bound-parameter limit on older builds
+        for i in range(0, len(unique_keys), 500):
+            part = unique_keys[i:i + 500]
+            with self._cache_lock:
+                rows = self.cache.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+            for key, vec in rows:
+                found[bytes(key)] = np.frombuffer(vec, dtype=np.float32).tolist()
+
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                misses.setdefault(key, text)
+
+        if misses:
+            vectors = self.embedding_model.embed_documents(list(misses.values()))
+            with self._cache_lock:
+                self.cache.executemany(
+                    "INSERT OR IGNORE INTO emb(key, vec) VALUES (?, ?)",
+                    [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in zip(misses, vectors)]
+                )
+                self.cache.commit()
+            found.update(zip(misses, vectors))
+
+        return [found[key] for key in keys]
+
+    def _load_seen(self):
+        metadatas = self.vectordb._collection.get(include=["metadatas"])["metadatas"]
+        self.seen = {m["content_hash"] for m in metadatas if m and "content_hash" in m}
+
+    def _new_chunks(self, chunks):
+        """Drops chunks whose content is already stored (or repeated within `chunks`)
+        and tags the rest with their content_hash."""
+        batch_seen = set()
+        new_chunks = []
+        for chunk in chunks:
+            h = hashlib.blake2b(chunk.page_content.encode("utf-8"), digest_size=16).hexdigest()
+            if h in self.seen or h in batch_seen:
+                continue
+            batch_seen.add(h)
+            chunk.metadata["content_hash"] = h
+            new_chunks.append(chunk)
+        return new_chunks
+
+    def _add_chunks(self, chunks):
+        # Embed through the cache ourselves and write the vectors straight into
+        # the collection, so Chroma does not embed the chunks a second time.
+        # The write is handed to the I/O pool; returns its future and the vectors.
+        texts = [c.page_content for c in chunks]
+        vectors = self.get_or_compute(texts)
+        # Content-hash ids make Chroma's upsert a second line of dedup
+        future = self._io_pool.submit(
+            self.vectordb._collection.upsert,
+            ids=[c.metadata["content_hash"] for c in chunks],
+            embeddings=vectors,
+            documents=texts,
+            metadatas=[c.metadata for c in chunks]
+        )
+        return future, vectors
+
+    def _finish_batch(self, chunks, future, vectors):
+        future.result()  # re-raise a failed write before anything is indexed locally
+        self._extend_fast_path(vectors, chunks)
+        self.seen.update(c.metadata["content_hash"] for c in chunks)
+
     def query_system(self, query):
         if not self.vectordb or not self.llm:
             return "System is not properly initialized. Check Ollama status.", []
 
         try:
-            retriever = self.vectordb.as_retriever(search_kwargs={"k": 3})
-            
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=self.llm, 
-                chain_type="stuff", 
-                retriever=retriever,
-                return_source_documents=True
-            )
-            
-            response = qa_chain.invoke({"query": query})
-            return response['result'], response['source_documents']
+            qv = self._query_vector(query)
+            generation = self._qcache_generation
+            cached = self._lookup_query_cache(qv)
+            if cached is not None:
+                return cached
+
+            # Direct prompt instead of a per-call RetrievalQA chain
+            docs = self._retrieve(qv, k=TOP_K)
+            answer = self.llm.invoke(self._build_prompt(query, qv, docs)).content
+            self._store_query_cache(qv, answer, docs, generation)
+            return answer, docs
         except Exception as e:
             return f"Error during query: {e}", []
 
+    def stream_query(self, query):
+        """Like query_system, but returns the answer as an iterator of LLM tokens."""
+        if not self.vectordb or not self.llm:
+            return iter(["System is not properly initialized. Check Ollama status."]), []
+
+        try:
+            qv = self._query_vector(query)
+            generation = self._qcache_generation
+            cached = self._lookup_query_cache(qv)
+            if cached is not None:
+                answer, sources = cached
+                return iter([answer]), sources
+
+            docs = self._retrieve(qv, k=TOP_K)
+            prompt = self._build_prompt(query, qv, docs)
+            return self._stream_answer(qv, prompt, docs, generation), docs
+        except Exception as e:
+            return iter([f"Error during query: {e}"]), []
+
+    def _build_prompt(self, query, qv, docs):
+        context = "\n\n".join(self._trim_to_relevant_sentences(qv, docs))
+        return QA_PROMPT_TEMPLATE.format(context=context, question=query)
+
+    def _trim_to_relevant_sentences(self, qv, docs):
+        """Keeps each chunk's CONTEXT_SENTENCES sentences most similar to the query,
+        in their original order, so less text goes through LLM prefill."""
+        split = [[s for s in SENTENCE_SPLIT.split(d.page_content) if s.strip()] for d in docs]
+        sentences = [s for parts in split if len(parts) > CONTEXT_SENTENCES for s in parts]
+        if not sentences:
+            return [d.page_content for d in docs]
+
+        # One batched (and cached) embedding call for every sentence that competes
+        vecs = np.asarray(self.get_or_compute(sentences), dtype=np.float32)
+        sims = (vecs @ qv) / np.linalg.norm(vecs, axis=1)
+
+        trimmed = []
+        offset = 0
+        for doc, parts in zip(docs, split):
+            if len(parts) <= CONTEXT_SENTENCES:
+                trimmed.append(doc.page_content)
+                continue
+            doc_sims = sims[offset:offset + len(parts)]
+            offset += len(parts)
+            keep = sorted(np.argsort(-doc_sims)[:CONTEXT_SENTENCES])
+            trimmed.append(" ".join(parts[i] for i in keep))
+        return trimmed
+
+    def _stream_answer(self, qv, prompt, docs, generation):
+        parts = []
+        try:
+            for chunk in self.llm.stream(prompt):
+                parts.append(chunk.content)
+                yield chunk.content
+        except Exception as e:
+            yield f"Error during query: {e}"
+            return
+        # Only a fully generated answer is worth caching
+        self._store_query_cache(qv, "".join(parts), docs, generation)
+
+    def _load_fast_path(self):
+        count = self.vectordb._collection.count() if self.vectordb is not None else 0
+        if count >= FAST_PATH_MAX_CHUNKS:
+            self._disable_fast_path()
+            return
+        if self._open_fast_path_files() == count:
+            return
+        # Missing or out of sync with the collection (e.g. an interrupted ingest): rebuild once
+        self._reset_fast_path()
+        if count:
+            data = self.vectordb._collection.get(include=["embeddings", "documents", "metadatas"])
+            docs = [Document(page_content=text, metadata=meta or {})
+                    for text, meta in zip(data["documents"], data["metadatas"])]
+            self._extend_fast_path(data["embeddings"], docs)
+
+    def _open_fast_path_files(self):
+        """Memory-maps the stored rows and returns how many there are (-1 if unusable)."""
+        if not all(os.path.exists(p) for p in (FAST_PATH_EMBEDS, FAST_PATH_SCALES, FAST_PATH_DOCS)):
+            return -1
+        with open(FAST_PATH_DOCS, encoding="utf-8") as f:
+            docs = [Document(**json.loads(line)) for line in f]
+        n = len(docs)
+        if n == 0 or os.path.getsize(FAST_PATH_SCALES) != 4 * n or os.path.getsize(FAST_PATH_EMBEDS) % n:
+            return -1
+        self._map_fast_path_rows(n)
+        self.docs = docs
+        return n
+
+    def _map_fast_path_rows(self, n):
+        # Pages fault in on demand; nothing is parsed or copied up front
+        self.mat = np.memmap(FAST_PATH_EMBEDS, dtype=np.int8, mode="r").reshape(n, -1)
+        self.scale = np.memmap(FAST_PATH_SCALES, dtype=np.float32, mode="r")
+
+    def _reset_fast_path(self):
+        self.mat = np.empty((0, 0), dtype=np.int8)
+        self.scale = np.empty(0, dtype=np.float32)
+        self.docs = []
+        shutil.rmtree(FAST_PATH_DIRECTORY, ignore_errors=True)
+
+    def _disable_fast_path(self):
+        # Corpus outgrew brute force; hand retrieval over to Chroma for good
+        self._fast_path = False
+        self._reset_fast_path()
+
+    def _extend_fast_path(self, vectors, docs):
+        if not self._fast_path or not len(docs):
+            return
+        if len(self.docs) + len(docs) >= FAST_PATH_MAX_CHUNKS:
+            self._disable_fast_path()
+            return
+        mat = np.asarray(vectors, dtype=np.float32)
+        mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+        # Symmetric per-row int8 quantization: 4x less RAM and memory traffic than float32
+        scale = np.abs(mat).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        quantized = np.round(mat / scale[:, np.newaxis]).astype(np.int8)
+
+        # Append to the raw files, then re-map only the numeric ones; the parsed
+        # Documents are already in memory, so docs.jsonl is never read back here
+        os.makedirs(FAST_PATH_DIRECTORY, exist_ok=True)
+        with open(FAST_PATH_EMBEDS, "ab") as f:
+            f.write(quantized.tobytes())
+        with open(FAST_PATH_SCALES, "ab") as f:
+            f.write(scale.astype(np.float32).tobytes())
+        with open(FAST_PATH_DOCS, "a", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}) + "\n")
+        all_docs = self.docs + list(docs)
+        # Rows before docs, so a concurrent _retrieve snapshot never outruns the matrix
+        self._map_fast_path_rows(len(all_docs))
+        self.docs = all_docs
+
+    def _scores(self, qv, n):
+        # NumPy has no int8 GEMV, so dequantize block by block against the float32 query
+        sims = np.empty(n, dtype=np.float32)
+        for i in range(0, n, SCORE_BLOCK_ROWS):
+            block = slice(i, min(i + SCORE_BLOCK_ROWS, n))
+            sims[block] = (self.mat[block].astype(np.float32) @ qv) * self.scale[block]
+        return sims
+
+    def _retrieve(self, qv, k=TOP_K):
+        """Top-k chunks for a normalized query vector, diversified with MMR."""
+        if not self._fast_path:
+            return self.vectordb.max_marginal_relevance_search_by_vector(
+                qv.tolist(), k=k, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA
+            )
+        # Snapshot first: an ingest may re-map the matrix (rows before docs) meanwhile
+        docs = self.docs
+        if not docs:
+            return []
+        sims = self._scores(qv, len(docs))
+        fetch_k = min(MMR_FETCH_K, len(docs))
+        candidates = np.argpartition(-sims, fetch_k - 1)[:fetch_k]
+        cand_vecs = self.mat[candidates].astype(np.float32) * self.scale[candidates][:, np.newaxis]
+        return [docs[candidates[i]] for i in self._mmr(sims[candidates], cand_vecs, k)]
+
+    @staticmethod
+    def _mmr(relevance, vecs, k, lambda_mult=MMR_LAMBDA):
+        # Greedy maximal marginal relevance over the candidate set
+        selected = [int(relevance.argmax())]
+        while len(selected) < min(k, len(vecs)):
+            redundancy = (vecs @ vecs[selected].T).max(axis=1)
+            score = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            score[selected] = -np.inf
+            selected.append(int(score.argmax()))
+        return selected
+
+    def _query_vector(self, query):
+        qv = np.asarray(self.embedding_model.embed_query(query), dtype=np.float32)
+        qv /= np.linalg.norm(qv)
+        return qv
+
+    def _lookup_query_cache(self, qv):
+        with self._qcache_lock:
+            if not self._qcache_vecs.size:
+                return None
+            sims = self._qcache_vecs @ qv
+            i = int(sims.argmax())
+            if sims[i] >= QUERY_CACHE_THRESHOLD:
+                return self._qcache_entries[i]
+            return None
+
+    def _store_query_cache(self, qv, answer, sources, generation):
+        with self._qcache_lock:
+            if generation != self._qcache_generation:
+                return  # the knowledge base changed while this answer was generated
+            if self._qcache_vecs.size:
+                self._qcache_vecs = np.vstack([self._qcache_vecs, qv])
+            else:
+                self._qcache_vecs = qv[np.newaxis, :]
+            self._qcache_entries.append((answer, sources))
+            # FIFO eviction once the cache is full
+            if len(self._qcache_entries) > QUERY_CACHE_SIZE:
+                self._qcache_vecs = self._qcache_vecs[1:]
+                self._qcache_entries.pop(0)
+
+    def _clear_query_cache(self):
+        # Cached answers were grounded in the old knowledge base
+        with self._qcache_lock:
+            self._qcache_generation += 1
+            self._qcache_vecs = np.empty((0, 0), dtype=np.float32)
+            self._qcache_entries = []
+
     def self_learn(self, query, answer):
         try:
             new_knowledge = f"Question: {query}\nVerified Answer: {answer}"
             doc = Document(page_content=new_knowledge, metadata={"source": "user_feedback"})
-            self.vectordb.add_documents([doc])
+            with self._write_lock:
+                new_chunks = self._new_chunks([doc])
+                if not new_chunks:
+                    return "I already know this answer."
+                self._finish_batch(new_chunks, *self._add_chunks(new_chunks))
+                self._clear_query_cache()
             return "System updated! I will remember this answer for next time."
         except Exception as e:
             return f"Error during self-learning: {e}"
@@ -96,48 +671,45 @@ class RAGSystem:
 # ---------------------------------------------------------
 # UI IMPLEMENTATION
 # ---------------------------------------------------------
+@st.cache_data
+def _css_blob() -> str:
+    # Read and wrapped once per process instead of rebuilt on every rerun
+    with open(CSS_PATH, encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
+
 def apply_custom_css():
-    st.markdown("""
-        <style>
-        .stApp {
-            background: linear-gradient(135deg, #0f0c29, #302b63, #24243e);
-            color: #ffffff;
-        }
-        .stTextInput > div > div > input {
-            background-color: rgba(255, 255, 255, 0.1);
-            color: white;
-            border-radius: 10px;
-            border: 1px solid rgba(255, 255, 255, 0.2);
-            padding: 10px;
-        }
-        .stButton > button {
-            background: linear-gradient(90deg, #4facfe 0%, #00f2fe 100%);
-            color: white;
-            border: none;
-            border-radius: 20px;
-            padding: 10px 25px;
-            font-weight: bold;
-            transition: transform 0.2s;
-        }
-        .stButton > button:hover {
-            transform: scale(1.05);
-            background: linear-gradient(90deg, #00f2fe 0%, #4facfe 100%);
-        }
-        .source-box {
-            background-color: rgba(255, 255, 255, 0.05);
-            border-radius: 10px;
-            padding: 15px;
-            border-left: 5px solid #4facfe;
-            margin-bottom: 10px;
-        }
-        h1, h2, h3 {
-            font-family: 'Inter', sans-serif;
-            background: -webkit-linear-gradient(#eee, #333);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    st.markdown(_css_blob(), unsafe_allow_html=True)
+
+@st.cache_resource
+def _build_rag() -> RAGSystem:
+    # Built once per server process and shared across sessions and reruns
+    return RAGSystem()
+
+@st.cache_data(ttl=CHROMA_PROBE_SECONDS, show_spinner=False)
+def _chroma_server_up() -> bool:
+    try:
+        chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT).heartbeat()
+        return True
+    except Exception:
+        return False
+
+_rebuild_lock = threading.Lock()
+
+def get_rag() -> RAGSystem:
+    rag = _build_rag()
+    if rag.llm is None:
+        # Initialization failed: retry at most every INIT_RETRY_SECONDS, and release
+        # the old instance before a new one touches the same caches and index files
+        if time.monotonic() - rag.created_at >= INIT_RETRY_SECONDS:
+            with _rebuild_lock:
+                if _build_rag() is rag:  # another session may have rebuilt it already
+                    rag.close()
+                    _build_rag.clear()
+            rag = _build_rag()
+    elif not rag.chroma_server and _chroma_server_up():
+        # Switch backends in place so sessions keep sharing one instance
+        rag.connect_chroma_server()
+    return rag
 
 def main():
     st.set_page_config(page_title="Pro-RAG | Qwen3", layout="wide")
@@ -146,8 +718,7 @@ def main():
     st.title("Pro-RAG System")
     st.markdown("### Next-Gen Retrieval Augmented Generation with Qwen3")
 
-    if 'rag' not in st.session_state:
-        st.session_state.rag = RAGSystem()
+    rag = get_rag()
 
     with st.sidebar:
         st.header("Knowledge Hub")
@@ -155,12 +726,10 @@ def main():
         uploaded_file = st.file_uploader("Choose a TXT file", type=["txt"])
         
         if uploaded_file:
-            with open("temp_data.txt", "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
             if st.button("Ingest Wisdom"):
                 with st.spinner("Processing knowledge chunks..."):
-                    msg = st.session_state.rag.ingest_documents("temp_data.txt")
+                    text = uploaded_file.getvalue().decode("utf-8", errors="replace")
+                    msg = rag.ingest_documents(text, uploaded_file.name)
                     if "Successfully" in msg:
                         st.success(msg)
                     else:
@@ -175,9 +744,9 @@ def main():
         if st.button("Generate Insight"):
             if user_query:
                 with st.spinner("Synthesizing context and reasoning..."):
-                    answer, sources = st.session_state.rag.query_system(user_query)
+                    token_stream, sources = rag.stream_query(user_query)
                     st.markdown("#### Generated Answer:")
-                    st.write(answer)
+                    answer = st.write_stream(token_stream)
                     st.session_state['last_query'] = user_query
                     st.session_state['last_answer'] = answer
                     st.session_state['last_sources'] = sources
@@ -185,14 +754,17 @@ def main():
     with col2:
         st.subheader("Contextual Anchors")
         if 'last_sources' in st.session_state and st.session_state['last_sources']:
-            for i, doc in enumerate(st.session_state['last_sources']):
-                with st.container():
-                    st.markdown(f"""
-                    <div class="source-box">
-                        <strong>Relational Chunk {i+1}</strong><br>
-                        <small>{doc.page_content[:400]}...</small>
-                    </div>
-                    """, unsafe_allow_html=True)
+            sources = st.session_state['last_sources']
+            key = hash(tuple((id(d), d.page_content[:50]) for d in sources))
+            if st.session_state.get('last_sources_key') != key:
+                st.session_state['last_sources_html'] = "".join(
+                    f'<div class="source-box"><strong>Relational Chunk {i+1}</strong><br>'
+                    f'<small>{doc.page_content[:400]}...</small></div>'
+                    for i, doc in enumerate(sources)
+                )
+                st.session_state['last_sources_key'] = key
+            # One markdown element for all sources instead of one per chunk
+            st.markdown(st.session_state['last_sources_html'], unsafe_allow_html=True)
         else:
             st.info("Retrieve an answer to see the source context here.")
         
@@ -202,7 +774,7 @@ def main():
             st.write("Is this insight accurate?")
             if st.button("Confirm & Learn"):
                 with st.spinner("Updating neural weights (DB injection)..."):
-                    msg = st.session_state.rag.self_learn(
+                    msg = rag.self_learn(
                         st.session_state['last_query'], 
                         st.session_state['last_answer']
                     )